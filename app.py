@@ -1,9 +1,15 @@
 #!/usr/bin/env python3
 
 import os
+import time
+import hashlib
 import logging
+import threading
+from urllib.parse import urlparse
 from flask import Flask, request, jsonify, send_from_directory, Response
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
+from flask_compress import Compress
 from dotenv import load_dotenv
 from wakeonlan import send_magic_packet
 
@@ -20,7 +26,8 @@ logging.basicConfig(
 # Import our modules
 from tv_utils import (
     SONY_TV_IP, SONY_TV_MAC, PSK,
-    make_sony_api_request,
+    make_sony_api_request, store_hdmi_labels, SESSION, EXECUTOR,
+    json_dumps, json_loads,
     set_power, set_volume, set_mute,
     launch_app, switch_input, send_ircc,
     resolve_app_name, friendly_input_name
@@ -34,50 +41,67 @@ logging.getLogger('werkzeug').setLevel(logging.ERROR)
 logging.info("Initializing background Status Manager...")
 status_manager.start()
 
+class FastJSONProvider(JSONProvider):
+    """Route jsonify() and request.get_json() through orjson (stdlib json if unavailable)."""
+    def dumps(self, obj, **kwargs):
+        return json_dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return json_loads(s)
+
 app = Flask(__name__, 
             static_folder='frontend/dist', 
             template_folder=None)
+app.json = FastJSONProvider(app)
 CORS(app)
+# gzip JSON payloads such as the app list; tiny status responses aren't worth it
+app.config["COMPRESS_MIN_SIZE"] = 1024
+Compress(app)
+
+# Device icons for HDMI inputs, keyed by a substring of the user-set label
+DEVICE_ICONS = {"ps5": "/icons/ps5.png", "ps4": "/icons/ps4.png", "switch": "/icons/switch.png"}
+
+# Remote key name -> Sony IRCC code
+IRCC_CODES = {
+    "Up": "AAAAAQAAAAEAAAB0Aw==", "Down": "AAAAAQAAAAEAAAB1Aw==",
+    "Left": "AAAAAQAAAAEAAAA0Aw==", "Right": "AAAAAQAAAAEAAAAzAw==",
+    "Confirm": "AAAAAQAAAAEAAABlAw==", "Return": "AAAAAgAAAJcAAAAjAw==",
+    "Home": "AAAAAQAAAAEAAABgAw==", "Back": "AAAAAgAAAJcAAAAjAw=="
+}
 
-# Cache for app icons to avoid heavy API calls
+# Cache for app icons to avoid heavy API calls (app URI -> icon URL)
 APP_ICONS_CACHE = {}
+APP_ICONS_TTL = 300
+# Serializes refreshes so a burst of requests triggers a single getApplicationList
+_ICONS_LOCK = threading.Lock()
+_ICONS_TS = 0.0
+# Icon URL -> time.monotonic() of its last failed download; not retried for APP_ICONS_TTL
+_ICON_FAILURES = {}
+# Icons are downloaded once and then served from here as /icons/cache/<file>
+ICON_CACHE_DIR = os.path.join(app.static_folder, 'icons', 'cache')
+
+# Stale-while-revalidate cache for the HDMI input list, fetched from the TV on every UI load
+HDMI_INPUTS_FRESH_TTL = float(os.getenv('HDMI_INPUTS_FRESH_TTL', '5'))
+HDMI_INPUTS_STALE_TTL = float(os.getenv('HDMI_INPUTS_STALE_TTL', '30'))
+_hdmi_inputs_cache = {"body": None, "fresh_until": 0, "stale_until": 0, "lock": threading.Lock(), "refreshing": False}
+
+# (status_manager.version, body) of the last render; swapped as one tuple so readers never see a mix
+_status_cache = (-1, b"")
 
 @app.route('/metrics')
 def prometheus_metrics():
-    """Expose TV metrics in Prometheus text format from the background status manager."""
-    status = status_manager.get_status()
-    lines = []
-
-    # Power state: map to numeric (1=active, 0.5=standby, 0=off/unknown)
-    power_status = status.get("power", "unknown")
-    power_val = 0
-    if power_status == "active":
-        power_val = 1
-    elif power_status == "standby":
-        power_val = 0.5
-
-    lines.append("# HELP tv_power_status TV power state (1=active, 0.5=standby, 0=off)")
-    lines.append("# TYPE tv_power_status gauge")
-    lines.append(f'tv_power_status {power_val}')
-
-    # Volume
-    volume = status.get("volume", 0)
-    lines.append("# HELP tv_volume Current TV volume level")
-    lines.append("# TYPE tv_volume gauge")
-    lines.append(f"tv_volume {volume}")
-
-    # Now Playing
-    now_playing_id = status.get("now_playing_id", 0)
-    lines.append("# HELP tv_now_playing Numeric ID of current content")
-    lines.append("# TYPE tv_now_playing gauge")
-    lines.append(f"tv_now_playing {now_playing_id}")
-
-    return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4; charset=utf-8")
+    """Expose TV metrics in Prometheus text format, pre-rendered by the background status manager."""
+    return Response(status_manager.get_metrics_body(), mimetype="text/plain; version=0.0.4; charset=utf-8")
 
 @app.route('/api/status')
 def get_status():
     """Get summarized TV status from background manager."""
-    return jsonify({**status_manager.get_status(), "success": True})
+    global _status_cache
+    version = status_manager.version
+    cached = _status_cache
+    if cached[0] != version:
+        cached = _status_cache = (version, json_dumps({**status_manager.get_status(), "success": True}))
+    return Response(cached[1], mimetype="application/json")
 
 @app.route('/api/health')
 def health_check():
@@ -99,11 +123,13 @@ def power_control():
             send_magic_packet(SONY_TV_MAC, ip_address=broadcast)
             send_magic_packet(SONY_TV_MAC, ip_address=SONY_TV_IP)
             set_power(True)
+            status_manager.expect_power_change()
             return jsonify({"success": True, "message": "TV wake command sent"})
         except Exception as e:
             return jsonify({"success": False, "error": str(e)})
     elif action == 'off':
         result = set_power(False)
+        status_manager.expect_power_change()
         return jsonify(result)
     return jsonify({"success": False, "error": "Invalid action"})
 
@@ -137,10 +163,10 @@ def get_channel():
         "uri": status.get("uri", "")
     })
 
-@app.route('/api/inputs/hdmi')
-def get_hdmi_inputs():
-    DEVICE_ICONS = {"ps5": "/icons/ps5.png", "ps4": "/icons/ps4.png", "switch": "/icons/switch.png"}
+def _fetch_hdmi_inputs():
     result = make_sony_api_request("avContent", "getCurrentExternalInputsStatus", [], "1.1")
+    # Same call the poller uses for HDMI labels; let it benefit from this fetch
+    store_hdmi_labels(result)
     if result["success"] and "result" in result["data"]:
         inputs = result["data"]["result"][0]
         hdmi = []
@@ -148,8 +174,9 @@ def get_hdmi_inputs():
             label = inp.get("label", "")
             icon = None
             if label:
+                lower_label = label.lower()
                 for key, path in DEVICE_ICONS.items():
-                    if key in label.lower():
+                    if key in lower_label:
                         icon = path
                         break
 
@@ -160,28 +187,150 @@ def get_hdmi_inputs():
                 "connected": inp.get("connection", False),
                 "icon": icon
             })
-        return jsonify({"success": True, "inputs": hdmi})
-    return jsonify({"success": False, "error": "Could not get HDMI status"})
+        return {"success": True, "inputs": hdmi}
+    return {"success": False, "error": "Could not get HDMI status"}
+
+def _refresh_hdmi_inputs():
+    """Fetch the HDMI inputs and store them in the cache (failures are not cached)."""
+    body = _fetch_hdmi_inputs()
+    if body["success"]:
+        now = time.time()
+        with _hdmi_inputs_cache["lock"]:
+            _hdmi_inputs_cache["body"] = body
+            _hdmi_inputs_cache["fresh_until"] = now + HDMI_INPUTS_FRESH_TTL
+            _hdmi_inputs_cache["stale_until"] = now + HDMI_INPUTS_STALE_TTL
+    return body
+
+def _background_refresh_hdmi_inputs():
+    try:
+        _refresh_hdmi_inputs()
+    except Exception as e:
+        logging.error(f"Error refreshing HDMI inputs: {e}")
+    finally:
+        with _hdmi_inputs_cache["lock"]:
+            _hdmi_inputs_cache["refreshing"] = False
+
+@app.route('/api/inputs/hdmi')
+def get_hdmi_inputs():
+    now = time.time()
+    cache = _hdmi_inputs_cache
+    with cache["lock"]:
+        body = cache["body"]
+        if body is not None and now < cache["fresh_until"]:
+            return jsonify(body)
+        if body is not None and now < cache["stale_until"]:
+            # Serve stale data immediately and let a single thread revalidate
+            if not cache["refreshing"]:
+                cache["refreshing"] = True
+                threading.Thread(target=_background_refresh_hdmi_inputs, daemon=True).start()
+            return jsonify(body)
+    return jsonify(_refresh_hdmi_inputs())
+
+def _fetch_icon(url):
+    """Download an app icon into ICON_CACHE_DIR (once) and return its local URL, or None."""
+    ext = os.path.splitext(urlparse(url).path)[1] or ".png"
+    fname = hashlib.sha256(url.encode()).hexdigest() + ext
+    path = os.path.join(ICON_CACHE_DIR, fname)
+    if not os.path.exists(path):
+        failed_at = _ICON_FAILURES.get(url)
+        if failed_at is not None and time.monotonic() - failed_at < APP_ICONS_TTL:
+            return None
+        try:
+            resp = SESSION.get(url, timeout=5)
+        except Exception as e:
+            logging.warning(f"Could not download icon {url}: {e}")
+            _ICON_FAILURES[url] = time.monotonic()
+            return None
+        if resp.status_code != 200:
+            _ICON_FAILURES[url] = time.monotonic()
+            return None
+        _ICON_FAILURES.pop(url, None)
+        # Write then rename so concurrent readers never see a partial file
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(resp.content)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.warning(f"Could not cache icon {url}: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return None
+    return f"/icons/cache/{fname}"
+
+def _app_icons_fresh():
+    return bool(APP_ICONS_CACHE) and time.monotonic() - _ICONS_TS < APP_ICONS_TTL
+
+def _cache_app_icons(apps):
+    """Fetch all app icons in parallel and point APP_ICONS_CACHE at the local copies. Call with _ICONS_LOCK held."""
+    global APP_ICONS_CACHE, _ICONS_TS
+    with_icon = [a for a in apps if a.get("uri") and a.get("icon")]
+    try:
+        os.makedirs(ICON_CACHE_DIR, exist_ok=True)
+        local_urls = EXECUTOR.map(lambda a: _fetch_icon(a["icon"]), with_icon)
+    except OSError as e:
+        # e.g. a read-only frontend/dist; the TV-hosted URLs still work
+        logging.warning(f"Icon cache unavailable: {e}")
+        local_urls = [None] * len(with_icon)
+    # Fall back to the TV-hosted URL for any icon that couldn't be downloaded
+    APP_ICONS_CACHE = {a["uri"]: local or a["icon"] for a, local in zip(with_icon, local_urls)}
+    _ICONS_TS = time.monotonic()
+
+def _refresh_app_icons():
+    """Re-read the app list and re-cache its icons. Call with _ICONS_LOCK held."""
+    result = make_sony_api_request("appControl", "getApplicationList")
+    # On failure keep serving the previous (possibly stale) map
+    if result["success"]:
+        _cache_app_icons(result["data"]["result"][0])
+
+def _background_cache_app_icons(apps=None):
+    """Run _cache_app_icons (or _refresh_app_icons when apps is None) off the request thread.
+
+    The caller must already hold _ICONS_LOCK; it is released here.
+    """
+    try:
+        if apps is None:
+            _refresh_app_icons()
+        else:
+            _cache_app_icons(apps)
+    finally:
+        _ICONS_LOCK.release()
 
 @app.route('/api/app-icons')
 def get_app_icons():
-    global APP_ICONS_CACHE
-    if not APP_ICONS_CACHE:
-        result = make_sony_api_request("appControl", "getApplicationList")
-        if result["success"]:
-            apps = result["data"]["result"][0]
-            APP_ICONS_CACHE = {a["uri"]: a["icon"] for a in apps if "uri" in a and "icon" in a}
+    if APP_ICONS_CACHE and not _app_icons_fresh():
+        # Serve the stale map right away and let a single thread revalidate it
+        if _ICONS_LOCK.acquire(blocking=False):
+            threading.Thread(target=_background_cache_app_icons, daemon=True).start()
+    elif not APP_ICONS_CACHE:
+        # Nothing to serve yet: the first load waits for the refresh
+        with _ICONS_LOCK:
+            # Another request may have refreshed the cache while we waited for the lock
+            if not APP_ICONS_CACHE:
+                _refresh_app_icons()
     
-    return jsonify({"success": True, "icons": APP_ICONS_CACHE})
+    response = jsonify({"success": True, "icons": APP_ICONS_CACHE})
+    if APP_ICONS_CACHE:
+        # Don't let the browser hold on to an empty map fetched while the TV was off
+        response.headers["Cache-Control"] = f"public, max-age={APP_ICONS_TTL}"
+    return response
+
+@app.route('/icons/cache/<path:fname>')
+def serve_cached_icon(fname):
+    """Serve a downloaded app icon; file names are derived from the icon URL, so let browsers keep them."""
+    return send_from_directory(ICON_CACHE_DIR, fname, max_age=86400)
 
 @app.route('/api/applications')
 def get_applications():
-    global APP_ICONS_CACHE
     result = make_sony_api_request("appControl", "getApplicationList")
     if result["success"]:
         apps = result["data"]["result"][0]
-        # Refresh cache while we're at it
-        APP_ICONS_CACHE = {a["uri"]: a["icon"] for a in apps if "uri" in a and "icon" in a}
+        # Refresh the icon cache while we're at it, without making the app list wait on downloads;
+        # skip it if another refresh is already running
+        if _ICONS_LOCK.acquire(blocking=False):
+            threading.Thread(target=_background_cache_app_icons, args=(apps,), daemon=True).start()
         return jsonify({"success": True, "applications": apps})
     return jsonify({"success": False, "error": "Could not get applications"})
 
@@ -199,12 +348,6 @@ def launch_app_api():
 
 @app.route('/api/remote', methods=['POST'])
 def remote_control():
-    IRCC_CODES = {
-        "Up": "AAAAAQAAAAEAAAB0Aw==", "Down": "AAAAAQAAAAEAAAB1Aw==",
-        "Left": "AAAAAQAAAAEAAAA0Aw==", "Right": "AAAAAQAAAAEAAAAzAw==",
-        "Confirm": "AAAAAQAAAAEAAABlAw==", "Return": "AAAAAgAAAJcAAAAjAw==",
-        "Home": "AAAAAQAAAAEAAABgAw==", "Back": "AAAAAgAAAJcAAAAjAw=="
-    }
     command = request.get_json().get('command')
     code = IRCC_CODES.get(command)
     if not code: return jsonify({"success": False, "error": "Unknown command"})
@@ -11,6 +11,10 @@ export default defineConfig({
         target: "http://localhost:5000",
         changeOrigin: true,
       },
+      "/icons/cache": {
+        target: "http://localhost:5000",
+        changeOrigin: true,
+      },
       "/metrics": {
         target: "http://localhost:5000",
         changeOrigin: true,
@@ -1,19 +1,48 @@
 import os
-import json
+import re
 import time
 import logging
+import select
+import functools
 import threading
 import subprocess
 from datetime import datetime
+from types import MappingProxyType
+from concurrent.futures import ThreadPoolExecutor
 from tv_utils import (
     make_sony_api_request, 
+    json_dumps,
     friendly_input_name, 
     resolve_app_name, 
+    make_sony_api_batch,
     get_hdmi_labels,
+    hdmi_labels_fresh,
+    store_hdmi_labels,
     SONY_TV_IP,
-    ADB_PORT
+    ADB_PORT,
+    POLL_WORKERS
 )
 
+# Seconds to hold off polling after a manual action so the TV has time to switch
+OVERRIDE_GRACE_PERIOD = 5
+
+# While the TV is off only its power state is polled, and at a slower rate
+LOW_POWER_STATES = ("standby", "offline")
+LOW_POWER_POLL_FACTOR = 3
+# Seconds to keep the normal poll rate after a power action, so the UI sees the TV come up
+POWER_CHANGE_WINDOW = 60
+
+# Sentinels delimiting each command's output on the persistent adb shell. They are
+# echoed with empty quotes spliced in, so that if adbd allocates a PTY and echoes the
+# command line back, the echo itself never contains a marker.
+ADB_MARK_START = "__MYTV_START__"
+ADB_MARK_END = "__MYTV_END__"
+_ADB_ECHO_START = 'echo __MYTV_""START__'
+_ADB_ECHO_END = 'echo __MYTV_""END__'
+
+# Package name from e.g. "mCurrentFocus=Window{1a2b u0 com.netflix.ninja/...MainActivity}"
+_FOCUS_RE = re.compile(r"mCurrentFocus=Window\{[^}]*u0 ([^/\s}]+)")
+
 # Mapping of "known" content to fixed integers. 0 is unknown/unmapped.
 NOW_PLAYING_ID_MAP = {
     "Unknown": 0,
@@ -41,10 +70,64 @@ NOW_PLAYING_ID_MAP = {
     "NBA": 112,
 }
 
+# Substring matcher over NOW_PLAYING_ID_MAP keys; longest first so "Apple TV" wins over "TV"
+_NOW_PLAYING_KEYS = sorted(NOW_PLAYING_ID_MAP, key=len, reverse=True)
+_NOW_PLAYING_RE = re.compile("|".join(f"(?P<k{i}>{re.escape(k)})" for i, k in enumerate(_NOW_PLAYING_KEYS)))
+_NOW_PLAYING_GROUPS = {f"k{i}": NOW_PLAYING_ID_MAP[k] for i, k in enumerate(_NOW_PLAYING_KEYS)}
+
+@functools.lru_cache(maxsize=64)
+def _now_playing_id(title):
+    """Map a title to its NOW_PLAYING_ID_MAP value; memoized since the same few titles repeat every poll."""
+    # Exact match
+    if title in NOW_PLAYING_ID_MAP:
+        return NOW_PLAYING_ID_MAP[title]
+
+    # Substring match for dynamic names (e.g. apps)
+    m = _NOW_PLAYING_RE.search(title)
+    return _NOW_PLAYING_GROUPS[m.lastgroup] if m else 0
+
+# Static HELP/TYPE headers for /metrics; only the sample lines change between renders
+_METRICS_UP_HEAD = (b"# HELP tv_up Whether the TV answered the last power poll (1=yes, 0=no)\n"
+                    b"# TYPE tv_up gauge\n")
+_METRICS_POWER_HEAD = (b"# HELP tv_power_status TV power state (1=active, 0.5=standby, 0=off)\n"
+                       b"# TYPE tv_power_status gauge\n")
+_METRICS_VOLUME_HEAD = (b"# HELP tv_volume Current TV volume level\n"
+                        b"# TYPE tv_volume gauge\n")
+_METRICS_NOW_PLAYING_HEAD = (b"# HELP tv_now_playing Numeric ID of current content\n"
+                             b"# TYPE tv_now_playing gauge\n")
+
+def render_metrics(status, tv_up):
+    """Render a status snapshot in Prometheus text format."""
+    # Power state: map to numeric (1=active, 0.5=standby, 0=off/unknown)
+    power_status = status.get("power", "unknown")
+    power_val = 0
+    if power_status == "active":
+        power_val = 1
+    elif power_status == "standby":
+        power_val = 0.5
+
+    return b"".join((
+        _METRICS_UP_HEAD,
+        b"tv_up %d\n" % tv_up,
+        _METRICS_POWER_HEAD,
+        b"tv_power_status %g\n" % power_val,
+        _METRICS_VOLUME_HEAD,
+        b"tv_volume %d\n" % status.get("volume", 0),
+        _METRICS_NOW_PLAYING_HEAD,
+        b"tv_now_playing %d\n" % status.get("now_playing_id", 0),
+    ))
+
+def _is_active(power_res):
+    """Whether a getPowerStatus result says the TV is on."""
+    return (power_res["success"] and "result" in power_res["data"]
+            and power_res["data"]["result"][0]["status"] == "active")
+
 class StatusManager:
     def __init__(self):
         self.poll_interval = int(os.getenv('POLL_INTERVAL', '10'))
         self.max_error_iterations = int(os.getenv('MAX_ERROR_ITERATIONS', '3'))
+        # Short per-call budget for background polls so an unreachable TV can't stall a cycle
+        self.request_timeout = float(os.getenv('POLL_TIMEOUT', '1.5'))
         
         self.current_status = {
             "power": "unknown",
@@ -57,6 +140,10 @@ class StatusManager:
         }
         
         # Track errors for each metric to implement grace period
+        # Unlike "power", which holds its last value through a few failed polls,
+        # this tracks whether the most recent getPowerStatus call succeeded
+        self._power_poll_ok = False
+
         self.error_counts = {
             "power": 0,
             "volume": 0,
@@ -64,17 +151,50 @@ class StatusManager:
         }
         
         self.lock = threading.Lock()
+        # Private pool so a burst of icon downloads on the shared EXECUTOR can't delay a poll
+        self._pool = ThreadPoolExecutor(max_workers=POLL_WORKERS, thread_name_prefix="tv-poll")
+        self.version = 0  # Bumped on every status change so readers can cache rendered output
+        self._publish()
         self.stop_event = threading.Event()
+        self._wake = threading.Event()
+        self._fast_poll_until = 0  # Normal poll rate even while off until then (see expect_power_change)
         self.last_override_time = 0  # Timestamp of last manual override
+
+        # Long-lived `adb shell` used by the now-playing fallback (avoids a connect + fork per poll)
+        self.adb_max_idle = int(os.getenv('ADB_MAX_IDLE', '300'))
+        self._adb_proc = None
+        self._adb_lock = threading.Lock()
+        self._adb_last_ok = 0
+        self._adb_connected = False  # Whether `adb connect` has succeeded since the last failure
         logging.info("Initializing StatusManager instance...")
         self.thread = threading.Thread(target=self._update_loop, daemon=True)
 
     def start(self):
         self.thread.start()
 
+    def expect_power_change(self):
+        """Poll now, and at the normal rate for a while, after a power on/off action."""
+        self._fast_poll_until = time.time() + POWER_CHANGE_WINDOW
+        self._wake.set()
+
+    def stop(self):
+        self.stop_event.set()
+        self._wake.set()
+
     def get_status(self):
-        with self.lock:
-            return self.current_status.copy()
+        """Read-only view of the latest status; swapped whole on change, so no lock is needed."""
+        return self._snapshot
+
+    def get_metrics_body(self):
+        """Prometheus exposition of the current status, rendered when it last changed."""
+        return self._metrics_body
+
+    def _publish(self):
+        """Freeze current_status for lock-free readers. Call with self.lock held."""
+        self._snapshot = MappingProxyType(dict(self.current_status))
+        self._metrics_body = render_metrics(self._snapshot, self._power_poll_ok)
+        # Bump last: a reader that sees the new version is guaranteed the new snapshot
+        self.version += 1
 
     def update_override(self, title, uri):
         """Manually override the status (e.g. after a launch action)."""
@@ -86,56 +206,82 @@ class StatusManager:
                 "timestamp": datetime.now().isoformat()
             })
             self.last_override_time = time.time()
+            self._publish()
             # Reset error count for now_playing since we just got a manual update
             self.error_counts["now_playing"] = 0
+        # Let the loop re-plan its sleep around the new grace period
+        self._wake.set()
 
 
     def _update_loop(self):
         logging.info("StatusManager background update loop started.")
         while not self.stop_event.is_set():
+            wait = self.poll_interval
             try:
                 # If we just had a manual override, skip polling to allow TV to switch
-                if time.time() - self.last_override_time < 5:
+                grace_left = OVERRIDE_GRACE_PERIOD - (time.time() - self.last_override_time)
+                if grace_left > 0:
                     logging.info("Skipping background poll due to recent manual override.")
+                    # Poll again as soon as the grace period ends to confirm what the TV switched to
+                    wait = grace_left
                 else:
                     self._refresh_status()
-                    # Log status as JSON
-                    logging.info(f"Current Status: {json.dumps(self.current_status)}")
+                    # Log status as JSON (skip the encode entirely when INFO is filtered out)
+                    if logging.getLogger().isEnabledFor(logging.INFO):
+                        logging.info("Current Status: %s", json_dumps(self.current_status).decode())
+                    if self._snapshot["power"] in LOW_POWER_STATES and time.time() > self._fast_poll_until:
+                        wait = self.poll_interval * LOW_POWER_POLL_FACTOR
             except Exception as e:
                 logging.error(f"Error in StatusManager loop: {e}")
             
-            time.sleep(self.poll_interval)
+            # Woken early by update_override(), expect_power_change() or stop()
+            self._wake.wait(wait)
+            self._wake.clear()
 
     def _refresh_status(self):
+        started = time.time()
         new_values = {}
-        
+
+        f_power = self._pool.submit(make_sony_api_request, "system", "getPowerStatus", timeout=self.request_timeout)
+        if self._snapshot["power"] in LOW_POWER_STATES and not _is_active(f_power.result()):
+            # Volume and content calls only fail against a TV that's off; poll power alone
+            f_vol = f_playing = None
+        else:
+            # Power, volume and now-playing are independent; fetch them concurrently
+            f_vol = self._pool.submit(make_sony_api_request, "audio", "getVolumeInformation", timeout=self.request_timeout)
+            # f_power was queued first, so waiting on it from the now-playing task can't deadlock the pool
+            f_playing = self._pool.submit(self._fetch_now_playing, f_power)
+
         # 1. Power Status
-        power_res = make_sony_api_request("system", "getPowerStatus")
+        power_res = f_power.result()
         if power_res["success"] and "result" in power_res["data"]:
             new_values["power"] = power_res["data"]["result"][0]["status"]
             self.error_counts["power"] = 0
+            self._power_poll_ok = True
         else:
             self.error_counts["power"] += 1
+            self._power_poll_ok = False
             if self.error_counts["power"] > self.max_error_iterations:
                 new_values["power"] = "offline"
 
-        # 2. Volume Status
-        vol_res = make_sony_api_request("audio", "getVolumeInformation")
-        if vol_res["success"] and "result" in vol_res["data"]:
-            vol_data = vol_res["data"]["result"]
-            if vol_data and isinstance(vol_data[0], list) and vol_data[0]:
-                for v in vol_data[0]:
-                    if v.get("target") == "speaker":
-                        new_values["volume"] = v.get("volume", 0)
-                        new_values["muted"] = v.get("mute", False)
-                        break
-            self.error_counts["volume"] = 0
-        else:
-            self.error_counts["volume"] += 1
-            # Keep previous if within grace period
+        # 2. Volume Status (last known value is kept while the TV is off)
+        if f_vol is not None:
+            vol_res = f_vol.result()
+            if vol_res["success"] and "result" in vol_res["data"]:
+                vol_data = vol_res["data"]["result"]
+                if vol_data and isinstance(vol_data[0], list) and vol_data[0]:
+                    for v in vol_data[0]:
+                        if v.get("target") == "speaker":
+                            new_values["volume"] = v.get("volume", 0)
+                            new_values["muted"] = v.get("mute", False)
+                            break
+                self.error_counts["volume"] = 0
+            else:
+                self.error_counts["volume"] += 1
+                # Keep previous if within grace period
 
         # 3. Now Playing Status
-        title, uri = self._fetch_now_playing()
+        title, uri = f_playing.result() if f_playing else ("Unknown", "")
         if title != "Unknown" or uri:
             new_values["title"] = title
             new_values["uri"] = uri
@@ -150,19 +296,37 @@ class StatusManager:
 
         # Update global status with new values
         with self.lock:
+            if self.last_override_time > started:
+                # A manual override landed mid-poll; don't clobber it with content fetched before it
+                for key in ("title", "uri", "now_playing_id"):
+                    new_values.pop(key, None)
             self.current_status.update(new_values)
             self.current_status["timestamp"] = datetime.now().isoformat()
+            self._publish()
+
+    def _fetch_now_playing(self, power_future):
+        # Nothing is playing on a TV that's off; only wait for this poll's power result
+        # when the TV wasn't already known to be on, so the common case stays concurrent
+        if self._snapshot["power"] != "active" and not _is_active(power_future.result()):
+            return "Unknown", ""
 
-    def _fetch_now_playing(self):
         # Prefer Sony API
-        res = make_sony_api_request("avContent", "getPlayingContentInfo")
+        if hdmi_labels_fresh():
+            res = make_sony_api_request("avContent", "getPlayingContentInfo", timeout=self.request_timeout)
+        else:
+            # Labels are due for a refresh; both calls live on avContent, so share one POST
+            res, inputs_res = make_sony_api_batch("avContent", [
+                ("getPlayingContentInfo", [], "1.0"),
+                ("getCurrentExternalInputsStatus", [], "1.1"),
+            ], timeout=self.request_timeout)
+            store_hdmi_labels(inputs_res)
         if res["success"] and "result" in res["data"] and res["data"]["result"]:
             info = res["data"]["result"][0]
             title = info.get("title", "")
             uri = info.get("uri", "")
             
             if uri and "hdmi" in uri:
-                labels = get_hdmi_labels()
+                labels = get_hdmi_labels(self.request_timeout)
                 title = labels.get(uri) or friendly_input_name(uri) or uri
             
             if not title and uri:
@@ -173,31 +337,77 @@ class StatusManager:
 
         # ADB Fallback
         try:
-            subprocess.run(["adb", "connect", f"{SONY_TV_IP}:{ADB_PORT}"], capture_output=True, timeout=2)
-            dump_cmd = f"adb -s {SONY_TV_IP}:{ADB_PORT} shell dumpsys window windows | grep -i 'mCurrentFocus'"
-            proc = subprocess.run(dump_cmd, shell=True, capture_output=True, text=True, timeout=3)
-            output = proc.stdout.strip()
-            
-            if output and "u0 " in output:
-                pkg = output.split("u0 ")[-1].split("/")[0].strip().replace('}', '')
-                if pkg:
-                    return resolve_app_name(pkg), pkg
+            # grep runs on the TV, keeping the transfer over the adb pipe to a line or two
+            output = self._adb_query("dumpsys window windows | grep -i 'mCurrentFocus'")
+            m = _FOCUS_RE.search(output)
+            if m:
+                pkg = m.group(1)
+                return resolve_app_name(pkg), pkg
         except Exception:
             pass
             
         return "Unknown", ""
 
+    def _adb_query(self, command, timeout=3):
+        """Run a command on the persistent adb shell and return its output."""
+        with self._adb_lock:
+            # Rebuild a connection that has sat unused long enough to have gone stale
+            if self._adb_proc and time.time() - self._adb_last_ok > self.adb_max_idle:
+                self._close_adb()
+            if self._adb_proc is None or self._adb_proc.poll() is not None:
+                self._start_adb()
+            try:
+                output = self._adb_exchange(command, timeout)
+            except (OSError, TimeoutError):
+                self._close_adb()
+                self._adb_connected = False
+                raise
+            self._adb_last_ok = time.time()
+            return output
+
+    def _start_adb(self):
+        target = f"{SONY_TV_IP}:{ADB_PORT}"
+        if not self._adb_connected:
+            proc = subprocess.run(["adb", "connect", target], capture_output=True, text=True, timeout=2)
+            self._adb_connected = proc.returncode == 0 and "connected" in proc.stdout
+        self._adb_proc = subprocess.Popen(
+            ["adb", "-s", target, "shell"],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, bufsize=0
+        )
+
+    def _close_adb(self):
+        proc, self._adb_proc = self._adb_proc, None
+        if proc and proc.poll() is None:
+            proc.kill()
+            proc.wait()
+
+    def _adb_exchange(self, command, timeout):
+        proc = self._adb_proc
+        proc.stdin.write(f"{_ADB_ECHO_START}; {command}; {_ADB_ECHO_END}\n".encode())
+        proc.stdin.flush()
+
+        # The end marker only counts at the start of a line; it always follows the start marker
+        end = b"\n" + ADB_MARK_END.encode()
+        fd = proc.stdout.fileno()
+        deadline = time.monotonic() + timeout
+        buf = b""
+        while end not in buf:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError("adb shell did not answer in time")
+            ready, _, _ = select.select([fd], [], [], remaining)
+            if ready:
+                chunk = os.read(fd, 65536)
+                if not chunk:
+                    raise OSError("adb shell exited")
+                buf += chunk
+
+        # Anything before the start marker (a PTY echo, a prompt) is discarded
+        output = buf.split(ADB_MARK_START.encode(), 1)[-1].split(end, 1)[0]
+        return output.decode(errors="replace")
+
     def _get_now_playing_id(self, title):
-        # Exact match
-        if title in NOW_PLAYING_ID_MAP:
-            return NOW_PLAYING_ID_MAP[title]
-        
-        # Substring match for dynamic names (e.g. apps)
-        for key, val in NOW_PLAYING_ID_MAP.items():
-            if key in title:
-                return val
-                
-        return 0
+        return _now_playing_id(title)
 
 # Global instance
 status_manager = StatusManager()
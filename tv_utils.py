@@ -1,15 +1,36 @@
 import os
+import re
+import json
+import time
 import socket
+import functools
 import requests
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from requests.adapters import HTTPAdapter
 from urllib3.poolmanager import PoolManager
+from urllib3.util.retry import Retry
+
+# orjson is several times faster on the JSON hot paths; fall back to the stdlib if it's missing
+try:
+    from orjson import dumps as json_dumps, loads as json_loads
+except ImportError:
+    def json_dumps(obj):
+        return json.dumps(obj, separators=(",", ":")).encode()
+    json_loads = json.loads
 
 # Configuration from environment
 SONY_TV_IP = os.getenv('SONY_TV_IP')
 SONY_TV_MAC = os.getenv('SONY_TV_MAC')
 PSK = os.getenv('SONY_TV_PSK')
 ADB_PORT = os.getenv('SONY_TV_ADB_PORT', '5555')
+SOURCE_IP = os.getenv('SONY_TV_SOURCE_IP')  # Optional: pin the local address used to reach the TV
+
+# Threads that may talk to the TV at once; the shared connection pool is sized from these
+REQUEST_THREADS = 16  # gunicorn --threads in the Dockerfile
+POLL_WORKERS = 3      # StatusManager's private pool
+IO_WORKERS = 4        # EXECUTOR
+BACKGROUND_REFRESHERS = 2  # HDMI input and app icon revalidation threads
 
 class SourceAddressAdapter(HTTPAdapter):
     def __init__(self, source_address, **kwargs):
@@ -21,8 +42,11 @@ class SourceAddressAdapter(HTTPAdapter):
             num_pools=connections, maxsize=maxsize,
             block=block, source_address=self.source_address)
 
+@functools.lru_cache(maxsize=1)
 def get_local_ip():
-    """Discover the local IP on the interface that can reach the TV."""
+    """Discover the local IP on the interface that can reach the TV (resolved once)."""
+    if SOURCE_IP:
+        return SOURCE_IP
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     try:
         s.connect((SONY_TV_IP, 1))
@@ -33,21 +57,55 @@ def get_local_ip():
         s.close()
     return IP
 
-def create_session():
+def _default_ip():
+    """IP the OS would pick anyway, in which case binding a source address is redundant."""
+    try:
+        return socket.gethostbyname(socket.gethostname())
+    except OSError:
+        return None
+
+def _build_session():
+    """Build the shared Session; the TV is a single static host so one pool serves every call."""
     session = requests.Session()
+    # Every Sony call is a POST. Retry refused connections and gateway errors once, but never a
+    # read timeout: the TV may already have applied a relative change such as volume "+5".
+    retries = Retry(total=1, read=0, backoff_factor=0.2,
+                    allowed_methods=frozenset(["POST"]), status_forcelist=(502, 503, 504))
+    # One connection per thread that can reach the TV, so none is discarded under load
+    pool_maxsize = REQUEST_THREADS + POLL_WORKERS + IO_WORKERS + BACKGROUND_REFRESHERS
+    adapter_kwargs = dict(pool_connections=4, pool_maxsize=pool_maxsize, max_retries=retries)
     local_ip = get_local_ip()
-    if local_ip != '0.0.0.0':
-        adapter = SourceAddressAdapter((local_ip, 0))
-        session.mount('http://', adapter)
+    if local_ip != '0.0.0.0' and (SOURCE_IP or local_ip != _default_ip()):
+        adapter = SourceAddressAdapter((local_ip, 0), **adapter_kwargs)
+    else:
+        adapter = HTTPAdapter(**adapter_kwargs)
+    session.mount('http://', adapter)
     return session
 
-def make_sony_api_request(url_suffix, method, params=None, version="1.0"):
+# Shared across Flask request threads and the status poller (urllib3 pools are thread-safe)
+SESSION = _build_session()
+
+def create_session():
+    """Kept for callers that predate the shared SESSION."""
+    return SESSION
+
+# Shared pool for fanning out independent TV calls (I/O releases the GIL)
+EXECUTOR = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="tv-io")
+
+_API_HEADERS = {"Content-Type": "application/json"}
+
+def _parse_sony_result(result):
+    """Wrap a decoded Sony JSON-RPC response in our success/error envelope."""
+    # Sony returns HTTP 200 even for API-level errors; check for "error" key
+    if "error" in result:
+        code, msg = result["error"][0], result["error"][1]
+        return {"success": False, "error": f"Sony API error {code}: {msg}"}
+    return {"success": True, "data": result}
+
+def make_sony_api_request(url_suffix, method, params=None, version="1.0", timeout=5):
     """Generic function to make Sony TV API requests"""
     url = f"http://{SONY_TV_IP}/sony/{url_suffix}"
-    headers = {
-        "X-Auth-PSK": PSK,
-        "Content-Type": "application/json"
-    }
+    headers = {**_API_HEADERS, "X-Auth-PSK": PSK}
     data = {
         "method": method,
         "id": 1,
@@ -55,65 +113,104 @@ def make_sony_api_request(url_suffix, method, params=None, version="1.0"):
         "version": version
     }
     
-    session = create_session()
+    session = SESSION
     try:
-        response = session.post(url, headers=headers, json=data, timeout=5)
+        response = session.post(url, headers=headers, data=json_dumps(data), timeout=timeout)
         if response.status_code == 200:
-            result = response.json()
-            # Sony returns HTTP 200 even for API-level errors; check for "error" key
-            if "error" in result:
-                code, msg = result["error"][0], result["error"][1]
-                return {"success": False, "error": f"Sony API error {code}: {msg}"}
-            return {"success": True, "data": result}
+            return _parse_sony_result(json_loads(response.content))
         else:
             return {"success": False, "error": f"HTTP {response.status_code}: {response.text}"}
     except Exception as e:
         return {"success": False, "error": str(e)}
 
+# None until the first batch attempt; False once the TV has rejected a JSON-RPC batch
+_batch_supported = None
+
+def make_sony_api_batch(url_suffix, calls, timeout=5):
+    """Send several (method, params, version) calls to one Sony service in a single POST.
+
+    Returns one make_sony_api_request-style result per call, in order. Falls back to
+    individual requests if the reply isn't a JSON array holding a result for every call,
+    and stops trying to batch only if the very first batch gets such a reply with HTTP 200.
+    """
+    global _batch_supported
+    if _batch_supported is not False:
+        url = f"http://{SONY_TV_IP}/sony/{url_suffix}"
+        headers = {**_API_HEADERS, "X-Auth-PSK": PSK}
+        data = [
+            {"method": method, "id": i, "params": params or [], "version": version}
+            for i, (method, params, version) in enumerate(calls, start=1)
+        ]
+        try:
+            response = SESSION.post(url, headers=headers, data=json_dumps(data), timeout=timeout)
+        except Exception as e:
+            # The TV is unreachable; individual requests would fail the same way
+            return [{"success": False, "error": str(e)} for _ in calls]
+        body = None
+        if response.status_code == 200:
+            try:
+                body = json_loads(response.content)
+            except ValueError:
+                pass
+        by_id = {}
+        if isinstance(body, list):
+            by_id = {item.get("id"): item for item in body if isinstance(item, dict)}
+        if all(i in by_id for i in range(1, len(calls) + 1)):
+            _batch_supported = True
+            return [_parse_sony_result(by_id[i]) for i in range(1, len(calls) + 1)]
+        if body is not None and _batch_supported is None:
+            # A well-formed reply that isn't one result per call: the TV doesn't do batches.
+            # HTTP errors and garbled bodies are treated as one-offs and leave the flag alone.
+            _batch_supported = False
+    return [make_sony_api_request(url_suffix, method, params, version, timeout) for method, params, version in calls]
+
+_PORT_RE = re.compile(r"port=(\d+)")
+# Input kind in one scan; hdmi is handled separately since it carries a port
+_INPUT_KIND_RE = re.compile(r"hdmi|^tv:|composite|component")
+_INPUT_NAMES = {"tv:": "TV", "composite": "AV", "component": "Component"}
+
 def friendly_input_name(uri):
     """Convert a Sony input URI to a human-readable name."""
     if not uri:
         return None
-    if 'hdmi' in uri:
-        try:
-            port = uri.split('port=')[1].split('&')[0]
-            return f"HDMI {port}"
-        except (IndexError, ValueError):
-            return "HDMI"
-    if uri.startswith('tv:'):
-        return "TV"
-    if 'composite' in uri:
-        return "AV"
-    if 'component' in uri:
-        return "Component"
-    return None
+    m = _INPUT_KIND_RE.search(uri)
+    if not m:
+        return None
+    if m.group(0) == "hdmi":
+        port = _PORT_RE.search(uri)
+        return f"HDMI {port.group(1)}" if port else "HDMI"
+    return _INPUT_NAMES[m.group(0)]
+
+# Substring of an app URI -> friendly name
+KNOWN_APPS = {
+    "netflix": "Netflix", "youtube": "YouTube", "disney": "Disney+",
+    "amazon": "Prime Video", "apple.atve": "Apple TV", "hbo": "HBO Max",
+    "spotify": "Spotify", "plex": "Plex", "twitch": "Twitch",
+    "crunchyroll": "Crunchyroll", "dazn": "DAZN", "atbat": "MLB",
+    "nba": "NBA",
+}
+# One alternation scanned in C; the matching group's name maps back to the friendly name.
+# Each branch is an anchored lookahead over the whole URI, so the first KNOWN_APPS key
+# present wins (dict order), not the key that occurs first in the URI.
+_APP_PATTERN = re.compile(
+    r"\A(?:" + "|".join(f"(?=.*?(?P<k{i}>{re.escape(k)}))" for i, k in enumerate(KNOWN_APPS)) + ")",
+    re.I | re.S,
+)
+_APP_GROUPS = {f"k{i}": name for i, name in enumerate(KNOWN_APPS.values())}
 
 def resolve_app_name(app_uri):
     """Derive a friendly app name from a Sony app URI."""
     if not app_uri:
         return "App"
-    known = {
-        "netflix": "Netflix", "youtube": "YouTube", "disney": "Disney+",
-        "amazon": "Prime Video", "apple.atve": "Apple TV", "hbo": "HBO Max",
-        "spotify": "Spotify", "plex": "Plex", "twitch": "Twitch",
-        "crunchyroll": "Crunchyroll", "dazn": "DAZN", "atbat": "MLB",
-    }
-    lower_uri = app_uri.lower()
-    for key, name in known.items():
-        if key in lower_uri:
-            return name
-            
-    # Custom rule for NBA
-    if "nba" in lower_uri:
-        return "NBA"
+    m = _APP_PATTERN.match(app_uri)
+    if m:
+        return _APP_GROUPS[m.lastgroup]
 
     # Last resort: extract last meaningful segment
-    parts = app_uri.split(".")
-    return parts[-1] if parts else "App"
+    return app_uri.split(".")[-1] or "App"
 
-def get_hdmi_labels():
-    """Fetch user-set HDMI labels from the TV (e.g. PS5, Switch)."""
-    result = make_sony_api_request("avContent", "getCurrentExternalInputsStatus", [], "1.1")
+def hdmi_labels_from_result(result):
+    """Extract {uri: label} from a getCurrentExternalInputsStatus result."""
     labels = {}
     if result["success"] and "result" in result["data"]:
         inputs = result["data"]["result"][0] if result["data"]["result"] else []
@@ -122,6 +219,31 @@ def get_hdmi_labels():
                 labels[inp["uri"]] = inp.get("label", "")
     return labels
 
+# HDMI labels change on human timescales; keep them for a while instead of refetching per poll
+HDMI_LABELS_TTL = 60
+_hdmi_labels_cache = {"value": None, "ts": 0}
+
+def hdmi_labels_fresh():
+    return _hdmi_labels_cache["value"] is not None and time.time() - _hdmi_labels_cache["ts"] < HDMI_LABELS_TTL
+
+def store_hdmi_labels(result):
+    """Cache the labels from a getCurrentExternalInputsStatus result and return them."""
+    labels = hdmi_labels_from_result(result)
+    if result["success"]:
+        _hdmi_labels_cache["value"] = labels
+        _hdmi_labels_cache["ts"] = time.time()
+    return labels
+
+def invalidate_hdmi_labels():
+    _hdmi_labels_cache["ts"] = 0
+
+def get_hdmi_labels(timeout=5):
+    """Fetch user-set HDMI labels from the TV (e.g. PS5, Switch)."""
+    if hdmi_labels_fresh():
+        return _hdmi_labels_cache["value"]
+    return store_hdmi_labels(
+        make_sony_api_request("avContent", "getCurrentExternalInputsStatus", [], "1.1", timeout))
+
 def set_power(status):
     return make_sony_api_request("system", "setPowerStatus", [{"status": status}])
 
@@ -136,17 +258,24 @@ def launch_app(uri):
     return make_sony_api_request("appControl", "setActiveApp", [{"uri": uri}])
 
 def switch_input(uri):
-    return make_sony_api_request("avContent", "setPlayContent", [{"uri": uri}], "1.0")
+    result = make_sony_api_request("avContent", "setPlayContent", [{"uri": uri}], "1.0")
+    if result["success"]:
+        # Let freshly renamed inputs show up right away
+        invalidate_hdmi_labels()
+    return result
 
-def send_ircc(code):
-    xml_body = f'''<?xml version="1.0"?>
+# SOAP envelope for IRCC key presses; only the code changes between calls
+_IRCC_TEMPLATE = b'''<?xml version="1.0"?>
 <s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">
   <s:Body>
     <u:X_SendIRCC xmlns:u="urn:schemas-sony-com:service:IRCC:1">
-      <IRCCCode>{code}</IRCCCode>
+      <IRCCCode>%b</IRCCCode>
     </u:X_SendIRCC>
   </s:Body>
 </s:Envelope>'''
+
+def send_ircc(code):
+    xml_body = _IRCC_TEMPLATE % code.encode()
     
     headers = {
         "Content-Type": "text/xml; charset=UTF-8",
@@ -155,7 +284,7 @@ def send_ircc(code):
     }
     
     url = f"http://{SONY_TV_IP}/sony/IRCC"
-    session = create_session()
+    session = SESSION
     try:
         resp = session.post(url, data=xml_body, headers=headers, timeout=5)
         if resp.status_code == 200: